@@ -1,15 +1,22 @@
-import json
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+import hashlib
 import logging
+import multiprocessing
 import os
 import signal
+import sys
 from typing import Union, Annotated, Literal
 
 import aiohttp
-from bs4 import BeautifulSoup
+from cachetools import TTLCache
 from dotenv import load_dotenv
 import html2text
+import orjson
 from pydantic import Field
-import requests
+from selectolax.lexbor import LexborHTMLParser
 
 from util.crawler.dynamic_crawler import DynamicCrawlerPool
 from mcp.server import FastMCP
@@ -17,11 +24,49 @@ from mcp.server import FastMCP
 
 load_dotenv()
 
-mcp = FastMCP('llm-search')
 
-serp_url = "https://serpapi.com/search"
+async def _preconnect(session: aiohttp.ClientSession):
+    try:
+        async with session.head(serp_origin, timeout=5):
+            pass
+    except Exception:
+        logging.debug("unable to preconnect to serpapi", exc_info=True)
+
+
+@asynccontextmanager
+async def _lifespan(server: FastMCP):
+    """Open a connection to SerpApi at startup so the first search finds the TLS handshake already done.
+
+    The warmup runs in the background so a slow or unreachable serpapi.com never delays the initialize reply.
+    """
+    session = await get_session()
+    preconnect_task = asyncio.create_task(_preconnect(session))
+    try:
+        yield
+    finally:
+        preconnect_task.cancel()
+        if not session.closed:
+            await session.close()
+
+mcp = FastMCP('llm-search', lifespan=_lifespan)
+
+serp_origin = "https://serpapi.com/"
+serp_url = serp_origin + "search"
 serp_api_key = os.getenv("SERP_API_KEY")
-crawler_pool = DynamicCrawlerPool(headless=True, mobile=False, EXECUTOR_TIMEOUT=60, run_js=True, use_proxy=False, max_crawlers=20)
+MAX_CRAWLERS = 20
+# pools are built on first use, so render workers re-importing this module don't start crawlers of their own
+crawler_pool: Union[DynamicCrawlerPool, None] = None
+# crawls block a thread each, so they get their own executor sized to the crawler pool instead of the loop's default one
+crawl_executor: Union[ThreadPoolExecutor, None] = None
+render_pool: Union[ProcessPoolExecutor, None] = None
+_RESULT_FIELDS = ("position", "title", "link", "snippet")
+_session: Union[aiohttp.ClientSession, None] = None
+# SerpApi caches identical searches for 1h, so mirror that locally to skip the round-trip
+_search_cache = TTLCache(maxsize=1024, ttl=3600)
+_CACHED_FIELDS = ("answer_box", "organic_results")
+_search_cache_lock = asyncio.Lock()
+# rendered markdown keyed on a hash of the page source, popular pages show up across many searches
+_markdown_cache = TTLCache(maxsize=4096, ttl=3600)
 
 @mcp.tool()
 async def llm_search(
@@ -35,12 +80,21 @@ async def llm_search(
 ):
     """Get web search results with the choice of a simple result list or full text content."""
     search_result = await search_light(query, location=location, start=start)
+    answer_box = search_result.get("answer_box")
+    # keep only the fields clients use; this also builds fresh dicts, so crawling never touches cached results
+    organic_results = [{k: res[k] for k in _RESULT_FIELDS if k in res} for res in search_result.get("organic_results", [])]
     if crawl:
-        crawl_all(search_result["organic_results"], total_time=8)
-    
-    search_result = {k: v for k, v in search_result.items() if k in ("answer_box", "organic_results")}
-    
-    return search_result
+        await crawl_all(organic_results, total_time=8)
+
+    return {"answer_box": answer_box, "organic_results": organic_results}
+
+async def get_session() -> aiohttp.ClientSession:
+    """Return the shared SerpApi session, creating it on first use so keep-alive connections are reused."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=50, ttl_dns_cache=300, keepalive_timeout=60)
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
 
 async def search_light(
     q: Annotated[str, Field(
@@ -65,61 +119,243 @@ async def search_light(
     zero_trace: Annotated[Union[bool, None], Field(
         description="Enterprise only. Parameter enables ZeroTrace mode. It can be set to false (default) or true. Enable this mode to skip storing search parameters, search files, and search metadata on our servers. This may make debugging more difficult.")] = None
 ):
-    """Search Google Light for fast, web search results"""
+    """Search Google Light for fast, web search results
+
+    Apart from async submissions, only the answer_box and organic_results of the response are returned.
+    """
 
     if location:
         q = q + ", location: %s"%location
 
-    payload = {
-        'engine': "google_light",
-        'q': q,
-        'api_key': serp_api_key,
-        'safe': safe,
-        'nfpr': nfpr,
-        'filter': filter,
-        'start': start,
-        'num': num,
-        'device': device,
-        'no_cache': no_cache,
-        'async': aasync,
-        'zero_trace': zero_trace
-    }
-    # Remove None values
-    payload = {k: v for k, v in payload.items() if v is not None}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(serp_url, params=payload, timeout=10, raise_for_status=True) as r:
-            response = await r.json()
+    # Build without None values in a single pass
+    payload = {k: v for k, v in (
+        ('engine', "google_light"),
+        ('q', q),
+        ('api_key', serp_api_key),
+        ('safe', safe),
+        ('nfpr', nfpr),
+        ('filter', filter),
+        ('start', start),
+        ('num', num),
+        ('device', device),
+        ('no_cache', no_cache),
+        ('async', aasync),
+        ('zero_trace', zero_trace),
+    ) if v is not None}
+    key = tuple(sorted((k, v) for k, v in payload.items() if k != "no_cache"))
+    if not no_cache and not aasync:
+        async with _search_cache_lock:
+            cached = _search_cache.get(key)
+        if cached is not None:
+            return cached
+    session = await get_session()
+    async with session.get(serp_url, params=payload, timeout=10, raise_for_status=True) as r:
+        response = await r.json(loads=orjson.loads)
+    if aasync:
+        return response
+    # llm_search only reads these, and full responses are too large to keep 1024 of
+    response = {k: response[k] for k in _CACHED_FIELDS if k in response}
+    async with _search_cache_lock:
+        _search_cache[key] = response
     return response
 
 
-def crawl_all(organic_results: list, total_time: float = 8):
-    if not organic_results:
-        return
-    url_to_idx = {}
-    for idx, res in enumerate(organic_results):
-        url_to_idx[res["link"]] = idx
+# aria-hidden only hides content from screen readers, and modal libraries set it on the whole app root while a
+# dialog (e.g. a cookie banner) is open, so it is only trusted on icon elements
+_STRIP_SELECTOR = ("head, nav, footer, aside, script, style, form, noscript, iframe, svg, "
+                   "[hidden], i[aria-hidden='true']")
+
+
+def _looks_like_html(page_source: Union[str, bytes]) -> bool:
+    """Cheap sniff to keep empty, PDF and JSON bodies away from the HTML parser."""
+    if not page_source:
+        return False
+    head = page_source[:64].lstrip()
+    if isinstance(head, bytes):
+        head = head.decode("latin-1")
+    return bool(head) and not head.startswith("%PDF") and head[0] not in "{["
+
+
+# configured once and reused; each render worker is a single-threaded process with its own copy
+_h2t = html2text.HTML2Text()
+_h2t.body_width = 0
+_h2t.ignore_images = True
+_h2t.ignore_emphasis = False
+_h2t.single_line_break = True
+
+
+def _render_page(page_source: Union[str, bytes]) -> str:
+    """Convert a crawled page to markdown. Runs in the render pool, so it must stay a top-level function."""
+    tree = LexborHTMLParser(page_source)
+    # one selector pass instead of a walk per tag; lexbor returns matches in document order,
+    # so walking them reversed removes nested matches before their ancestors
+    for node in reversed(tree.css(_STRIP_SELECTOR)):
+        node.decompose()
+    root = tree.body or tree.root
+    return _h2t.handle(root.html) if root else ""
+
+
+def get_crawler_pool() -> DynamicCrawlerPool:
+    global crawler_pool
+    if crawler_pool is None:
+        crawler_pool = DynamicCrawlerPool(headless=True, mobile=False, EXECUTOR_TIMEOUT=60, run_js=True, use_proxy=False, max_crawlers=MAX_CRAWLERS)
+    return crawler_pool
+
+
+def get_crawl_executor() -> ThreadPoolExecutor:
+    global crawl_executor
+    if crawl_executor is None:
+        crawl_executor = ThreadPoolExecutor(max_workers=MAX_CRAWLERS, thread_name_prefix="crawl")
+    return crawl_executor
+
+
+def get_render_pool() -> ProcessPoolExecutor:
+    """Return the render pool, (re)building it if it is missing or broken by a crashed worker.
+
+    Workers are started with forkserver (or spawn) rather than fork, since the server process already runs
+    crawler and event loop threads by the time the first page is rendered.
+    """
+    global render_pool
+    if render_pool is None or render_pool._broken:
+        if render_pool is not None:
+            logging.warning("render pool is broken, starting a new one")
+            render_pool.shutdown(wait=False, cancel_futures=True)
+        methods = multiprocessing.get_all_start_methods()
+        mp_context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        render_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=mp_context)
+    return render_pool
+
+
+def _submit_render(loop: asyncio.AbstractEventLoop, page_source: Union[str, bytes]) -> asyncio.Future:
     try:
-        page_sources = crawler_pool.dynamic_crawl_multi_urls(list(url_to_idx.keys()), wait_time=0, total_time=total_time)
-    except Exception:
-        logging.error("unable to crawl", exc_info=True)
-    for url, page_source in page_sources.items():
+        return loop.run_in_executor(get_render_pool(), _render_page, page_source)
+    except BrokenProcessPool:
+        # a worker died since the last check, retry once on a fresh pool
+        return loop.run_in_executor(get_render_pool(), _render_page, page_source)
+
+
+async def dynamic_crawl_multi_urls_iter(urls: list, total_time: float = 8, max_parallel: int = 8,
+                                        per_url_timeout: Union[float, None] = None):
+    """Crawl urls concurrently and yield (url, page_source) as soon as each page arrives.
+
+    Crawls run on a crawl executor shared by all requests and sized to the crawler pool. At most max_parallel
+    of them belong to this call at once so one request cannot starve the others; urls are started in the
+    given order, so top-ranked results are crawled first. A url taking longer than per_url_timeout is
+    skipped, and whatever has not finished after total_time is dropped.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_crawler_pool()
+    executor = get_crawl_executor()
+    sem = asyncio.Semaphore(min(len(urls), max_parallel) or 1)
+    url_timeout = per_url_timeout or total_time
+
+    timed_out = set()
+
+    def release(crawl: asyncio.Future):
+        # the thread can't be stopped, so a timed-out crawl keeps its slot until it actually returns
+        sem.release()
+        # nobody awaits a timed-out crawl anymore, so its failure is only reported here
+        if crawl in timed_out and not crawl.cancelled() and crawl.exception() is not None:
+            logging.debug("crawl failed after it was given up on", exc_info=crawl.exception())
+
+    async def crawl_one(url):
+        await sem.acquire()
+        started = asyncio.Event()
+
+        def run():
+            loop.call_soon_threadsafe(started.set)
+            return pool.dynamic_crawl_multi_urls([url], wait_time=0, total_time=url_timeout)
+
+        job = executor.submit(run)
+        crawl = asyncio.wrap_future(job)
+        crawl.add_done_callback(release)
+        try:
+            # the per-url clock starts once a crawl thread picks the url up, not while it waits in the queue
+            await started.wait()
+        except asyncio.CancelledError:
+            # drop it if still queued; a crawl that already started keeps its slot until it returns
+            job.cancel()
+            raise
         try:
-            soup = BeautifulSoup(page_source, "html.parser")
-            for tag in soup(["nav", "footer", "aside", "script", "style", "form"]):
-                tag.decompose()
-            page_source = soup.prettify()
-            markdown = html2text.html2text(page_source)
-            res = organic_results[url_to_idx[url]]
-            res["text_content"] = markdown
-        except Exception as e:
-            logging.warning(f"fail parse page_source {page_source}", exc_info=True)
+            page_sources = await asyncio.wait_for(asyncio.shield(crawl), timeout=url_timeout)
+        except asyncio.TimeoutError:
+            timed_out.add(crawl)
+            logging.warning(f"skip {url}, crawl exceeded {url_timeout}s")
+            return url, None
+        # one url per call, so take the only page regardless of how the crawler keyed it (redirects, normalisation)
+        return url, next(iter(page_sources.values()), None) if page_sources else None
+
+    # assumes DynamicCrawlerPool.dynamic_crawl_multi_urls is safe to call from several threads at once
+    tasks = [asyncio.create_task(crawl_one(url)) for url in urls]
+    try:
+        for future in asyncio.as_completed(tasks, timeout=total_time):
+            try:
+                url, page_source = await future
+            except asyncio.TimeoutError:
+                logging.warning(f"crawl exceeded {total_time}s, returning partial results")
+                break
+            except Exception:
+                logging.error("unable to crawl", exc_info=True)
+                continue
+            if page_source is not None:
+                yield url, page_source
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def crawl_all(organic_results: list, total_time: float = 8):
+    if not organic_results:
+        return
+    url_to_idx = {res["link"]: idx for idx, res in enumerate(organic_results)}
+    if len(url_to_idx) < len(organic_results):
+        logging.info(f"skip {len(organic_results) - len(url_to_idx)} duplicate urls")
+    loop = asyncio.get_running_loop()
+    urls, keys, tasks = [], [], []
+    async for url, page_source in dynamic_crawl_multi_urls_iter(
+            list(url_to_idx.keys()), total_time=total_time, per_url_timeout=total_time / 2):
+        if not _looks_like_html(page_source):
+            logging.info(f"skip non-html page_source of {url}")
+            continue
+        raw = page_source.encode() if isinstance(page_source, str) else page_source
+        key = hashlib.blake2b(raw, digest_size=16).digest()
+        markdown = _markdown_cache.get(key)
+        if markdown is not None:
+            organic_results[url_to_idx[url]]["text_content"] = markdown
+            continue
+        urls.append(url)
+        keys.append(key)
+        tasks.append(_submit_render(loop, page_source))
+    markdowns = await asyncio.gather(*tasks, return_exceptions=True)
+    for url, key, markdown in zip(urls, keys, markdowns):
+        if isinstance(markdown, BaseException):
+            logging.warning(f"fail parse page_source of {url}", exc_info=markdown)
+            continue
+        _markdown_cache[key] = markdown
+        organic_results[url_to_idx[url]]["text_content"] = markdown
 
 def shutdown(signum, frame):
     logging.info(f"received signal {signum}")
-    crawler_pool.close()
-    logging.info("closed crawler pool")
+    if crawler_pool is not None:
+        crawler_pool.close()
+        logging.info("closed crawler pool")
+    if crawl_executor is not None:
+        crawl_executor.shutdown(wait=False, cancel_futures=True)
+    if render_pool is not None:
+        render_pool.shutdown(wait=False, cancel_futures=True)
+    if _session is not None and not _session.closed:
+        try:
+            asyncio.get_running_loop().create_task(_session.close())
+        except RuntimeError:
+            logging.warning("no running event loop, unable to close http session")
 
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, shutdown)
     signal.signal(signal.SIGTERM, shutdown)
+    if sys.platform != "win32":
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            logging.info("uvloop not installed, using the default asyncio event loop")
     mcp.run(transport="stdio")
\ No newline at end of file